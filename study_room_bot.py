@@ -2,12 +2,13 @@ import discord
 from discord.ext import commands
 from discord import app_commands
 import asyncio
-from datetime import datetime, timedelta
-import sqlite3
-import matplotlib.pyplot as plt
+import heapq
+from collections import defaultdict
+import aiosqlite
 import io
-import pandas as pd
+import math
 import os
+import time
 
 # --- Configuration ---
 BOT_TOKEN = os.getenv("DISCORD_BOT_TOKEN")
@@ -18,6 +19,111 @@ if not BOT_TOKEN:
     exit()
 
 DB_NAME = "study_data.db"
+DB_PRAGMAS = (
+    "journal_mode=WAL",
+    "synchronous=NORMAL",
+    "temp_store=MEMORY",
+    "cache_size=-64000",  # 64MB page cache
+    "mmap_size=268435456",
+)
+SESSION_FLUSH_INTERVAL = 5  # seconds between batched session writes
+SESSION_FLUSH_BATCH = 50    # flush early once this many sessions are pending
+STATS_CACHE_TTL = 60        # seconds a /studystats total is reused
+REPORT_CACHE_TTL = 300      # seconds a rendered /weeklyreport image is reused
+ACCESS_ROLE_LIMIT = 100     # owner access roles kept for reuse before the least recently used is deleted
+GUILD_ROLE_LIMIT = 250      # Discord's cap on roles per guild
+# Schema migrations, applied in order and tracked with PRAGMA user_version.
+# Entry N upgrades a database at version N to N+1; never edit one that has shipped.
+SCHEMA_MIGRATIONS = [
+    # 1: sessions table and its lookup indexes (IF NOT EXISTS adopts pre-versioned databases)
+    (
+        '''
+        CREATE TABLE IF NOT EXISTS sessions (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            partner_id INTEGER,
+            start_time TEXT NOT NULL,
+            end_time TEXT,
+            duration_seconds INTEGER,
+            topic TEXT
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_sessions_start ON sessions(start_time)',
+        'CREATE INDEX IF NOT EXISTS idx_sessions_user ON sessions(user_id)',
+        'CREATE INDEX IF NOT EXISTS idx_sessions_partner ON sessions(partner_id)',
+    ),
+    # 2: start_time/end_time as INTEGER unix seconds instead of local ISO-8601 text.
+    # SQLite can't change a column's type in place, so the table is rebuilt.
+    (
+        '''
+        CREATE TABLE sessions_new (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            partner_id INTEGER,
+            start_time INTEGER NOT NULL,
+            end_time INTEGER,
+            duration_seconds INTEGER,
+            topic TEXT
+        )
+        ''',
+        '''
+        INSERT INTO sessions_new (id, user_id, partner_id, start_time, end_time, duration_seconds, topic)
+        SELECT id, user_id, partner_id,
+               CAST(strftime('%s', start_time, 'utc') AS INTEGER),
+               CAST(strftime('%s', end_time, 'utc') AS INTEGER),
+               duration_seconds, topic
+        FROM sessions
+        ''',
+        'DROP TABLE sessions',
+        'ALTER TABLE sessions_new RENAME TO sessions',
+        'CREATE INDEX idx_sessions_start ON sessions(start_time)',
+        'CREATE INDEX idx_sessions_user ON sessions(user_id)',
+        'CREATE INDEX idx_sessions_partner ON sessions(partner_id)',
+    ),
+    # 3: open rooms, so a restart can resume their timers instead of orphaning them
+    (
+        '''
+        CREATE TABLE rooms (
+            channel_id INTEGER PRIMARY KEY,
+            owner_id INTEGER NOT NULL,
+            partner_id INTEGER NOT NULL,
+            role_id INTEGER NOT NULL,
+            start_time INTEGER NOT NULL,
+            deadline INTEGER NOT NULL,
+            duration_minutes INTEGER NOT NULL,
+            topic TEXT
+        )
+        ''',
+    ),
+]
+# Hot-path statements live in constants so every call hits sqlite3's statement cache.
+SQL_INSERT_SESSION = '''
+    INSERT INTO sessions (user_id, partner_id, start_time, end_time, duration_seconds, topic)
+    VALUES (?, ?, ?, ?, ?, ?)
+'''
+# Two indexed sums instead of one OR filter, which would force a full scan.
+# Self-partnered rows are only counted once.
+SQL_SUM_USER = '''
+    SELECT (SELECT COALESCE(SUM(duration_seconds), 0) FROM sessions WHERE user_id=?)
+         + (SELECT COALESCE(SUM(duration_seconds), 0) FROM sessions WHERE partner_id=? AND user_id<>?)
+'''
+# Let SQLite bucket by weekday so at most 7 rows per user come back.
+SQL_WEEKLY = '''
+    SELECT user_id, CAST(strftime('%w', start_time, 'unixepoch', 'localtime') AS INTEGER) AS dow, SUM(duration_seconds) / 3600.0
+    FROM sessions
+    WHERE start_time >= ?
+    GROUP BY dow, user_id
+'''
+SQL_INSERT_ROOM = '''
+    INSERT INTO rooms (channel_id, owner_id, partner_id, role_id, start_time, deadline, duration_minutes, topic)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+'''
+SQL_DELETE_ROOM = 'DELETE FROM rooms WHERE channel_id=?'
+SQL_SELECT_ROOMS = '''
+    SELECT channel_id, owner_id, partner_id, role_id, start_time, deadline, duration_minutes, topic FROM rooms
+'''
+# Viridis colour stops; report series are spread evenly between them.
+REPORT_PALETTE = [(68,1,84), (59,82,139), (33,145,140), (94,201,98), (253,231,37)]
 
 intents = discord.Intents.default()
 intents.members = True
@@ -28,33 +134,77 @@ class StudyBot(commands.Bot):
     def __init__(self):
         super().__init__(command_prefix='!', intents=intents)
         self.db_conn = None
-        self.db_cursor = None
         self.active_rooms = {}
         self.owner_to_channel = {}
-        self.setup_db()
+        self._pending_sessions: list[tuple] = []
+        self._pending_room_deletes: list[tuple] = []  # rooms rows dropped in the same flush as their session
+        self._flush_event = asyncio.Event()
+        self._write_lock = asyncio.Lock()  # keeps other writes out of an open flush transaction
+        self._flush_task = None
+        self._stats_cache: dict[int, tuple[int, float]] = {}
+        self._sessions_generation = 0  # bumped on every logged session; guards cache writes after an await
+        self._report_cache: dict[int, tuple[float, bytes]] = {}
+        self._user_access_role: dict[int, int] = {}  # owner_id -> reusable access role id, least recently used first
+        self._name_cache: dict[tuple[int, int], str] = {}  # (guild_id, user_id) -> display name
+        self._expiry_heap: list[tuple[float, int]] = []  # (loop.time() deadline, channel_id)
+        self._expiry_event = asyncio.Event()
+        self._expiry_task = None
+        self._rooms_restored = False
 
-    def setup_db(self):
+    async def setup_hook(self):
+        await self.setup_db()
+        self._flush_task = asyncio.create_task(self._flush_loop())
+        self._expiry_task = asyncio.create_task(self._expiry_dispatcher())
+
+    async def close(self):
+        for task in (self._expiry_task, self._flush_task):
+            if task:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self._expiry_task = self._flush_task = None
+        if self.db_conn:
+            await self._flush_sessions()
+            await self.db_conn.close()
+            self.db_conn = None
+        await super().close()
+
+    async def setup_db(self):
         try:
-            self.db_conn = sqlite3.connect(DB_NAME)
-            self.db_cursor = self.db_conn.cursor()
-            self.db_cursor.execute('''
-                CREATE TABLE IF NOT EXISTS sessions (
-                    id INTEGER PRIMARY KEY,
-                    user_id INTEGER NOT NULL,
-                    partner_id INTEGER,
-                    start_time TEXT NOT NULL,
-                    end_time TEXT,
-                    duration_seconds INTEGER,
-                    topic TEXT
-                )
-            ''')
-            self.db_conn.commit()
+            # Autocommit mode: the session flush opens its own explicit transaction.
+            self.db_conn = await aiosqlite.connect(DB_NAME, isolation_level=None, cached_statements=256)
+            for pragma in DB_PRAGMAS:
+                await self.db_conn.execute(f"PRAGMA {pragma}")
+            await self._migrate_db()
             print("SQLite database setup complete.")
         except Exception as e:
             print(f"Error setting up database: {e}")
 
+    async def _migrate_db(self):
+        async with self.db_conn.execute("PRAGMA user_version") as cur:
+            current = (await cur.fetchone())[0]
+        # Up-to-date databases skip all DDL; each step commits atomically with its version bump.
+        for version, statements in enumerate(SCHEMA_MIGRATIONS[current:], start=current + 1):
+            await self.db_conn.execute("BEGIN IMMEDIATE")
+            try:
+                for sql in statements:
+                    await self.db_conn.execute(sql)
+                await self.db_conn.execute(f"PRAGMA user_version={version}")
+                await self.db_conn.commit()
+            except BaseException:
+                await self.db_conn.rollback()
+                raise
+            print(f"Migrated database schema to version {version}.")
+
     async def on_ready(self):
         print(f'Logged in as {self.user} (ID: {self.user.id})')
+        # on_ready fires again after reconnects; rooms only need restoring once per process.
+        # Restored before the sync so a failed sync can't leave rooms untracked.
+        if not self._rooms_restored:
+            self._rooms_restored = True
+            await self._restore_rooms()
         guild = discord.Object(id=GUILD_ID)
         await self.tree.sync(guild=guild)
         print(f"Slash commands synced for guild {GUILD_ID}")
@@ -62,14 +212,96 @@ class StudyBot(commands.Bot):
         # await self.tree.sync()
         # print("Slash commands synced globally")
 
+    # --- Room persistence ---
+    async def _save_room(self, channel_id, room_data):
+        deadline = room_data['start_time_unix'] + room_data['duration_minutes'] * 60
+        async with self._write_lock:
+            await self.db_conn.execute(SQL_INSERT_ROOM, (channel_id, room_data['owner_id'], room_data['partner_id'],
+                                                         room_data['role_id'], room_data['start_time_unix'], deadline,
+                                                         room_data['duration_minutes'], room_data['topic']))
+
+    async def _restore_rooms(self):
+        async with self.db_conn.execute(SQL_SELECT_ROOMS) as cur:
+            rows = await cur.fetchall()
+        now = int(time.time())
+        stale = []
+        for channel_id, owner_id, partner_id, role_id, start_time_unix, deadline, duration_minutes, topic in rows:
+            self.active_rooms[channel_id] = {'owner_id': owner_id,
+                                             'partner_id': partner_id,
+                                             'role_id': role_id,
+                                             'duration_minutes': duration_minutes,
+                                             'start_time_unix': start_time_unix,
+                                             'start_mono': time.monotonic() - (now - start_time_unix),
+                                             'topic': topic}
+            self.owner_to_channel[owner_id] = channel_id
+            self._user_access_role[owner_id] = role_id
+            channel = self.get_channel(channel_id)
+            if deadline <= now:
+                stale.append((channel_id, "Timed session expired while the bot was offline.", duration_minutes * 60, topic))
+            elif channel is None or not any(not m.bot for m in channel.members):
+                # Voice updates that emptied the room were missed while offline.
+                stale.append((channel_id, "Study room was empty or gone when the bot restarted.", 0, topic))
+            else:
+                self._schedule_expiry(channel_id, deadline - now)
+        for channel_id, reason, duration_seconds, topic in stale:
+            await self._perform_cleanup(channel_id, reason, duration_seconds=duration_seconds, topic=topic)
+        if stale:
+            # One transaction for all the recovered sessions and their room rows, not one per room.
+            await self._flush_sessions()
+        print(f"Restored {len(rows)} study rooms ({len(stale)} cleaned up).")
+
     # --- Session logging & cleanup functions ---
-    async def _log_session(self, owner_id, partner_id, start_time, duration_seconds, topic):
-        end_time = start_time + timedelta(seconds=duration_seconds)
-        self.db_cursor.execute('''
-            INSERT INTO sessions (user_id, partner_id, start_time, end_time, duration_seconds, topic)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (owner_id, partner_id, start_time.isoformat(), end_time.isoformat(), duration_seconds, topic))
-        self.db_conn.commit()
+    async def _log_session(self, owner_id, partner_id, start_time_unix, duration_seconds, topic, channel_id=None):
+        end_time_unix = start_time_unix + duration_seconds
+        self._pending_sessions.append((owner_id, partner_id, start_time_unix, end_time_unix, duration_seconds, topic))
+        if channel_id is not None:
+            # Deleted with the session insert, so a crash before the flush leaves the room to be recovered.
+            self._pending_room_deletes.append((channel_id,))
+        self._sessions_generation += 1
+        self._stats_cache.pop(owner_id, None)
+        self._stats_cache.pop(partner_id, None)
+        # Sessions aren't stored per guild, so every cached report is stale now.
+        self._report_cache.clear()
+        if len(self._pending_sessions) >= SESSION_FLUSH_BATCH:
+            self._flush_event.set()
+
+    async def _flush_sessions(self):
+        async with self._write_lock:
+            if not self._pending_sessions and not self._pending_room_deletes:
+                return
+            batch, self._pending_sessions = self._pending_sessions, []
+            room_deletes, self._pending_room_deletes = self._pending_room_deletes, []
+            committing = False
+            try:
+                await self.db_conn.execute("BEGIN IMMEDIATE")
+                await self.db_conn.executemany(SQL_INSERT_SESSION, batch)
+                await self.db_conn.executemany(SQL_DELETE_ROOM, room_deletes)
+                committing = True
+                await self.db_conn.commit()
+            except BaseException as e:
+                if isinstance(e, asyncio.CancelledError):
+                    # Cancelling the await doesn't stop aiosqlite's worker thread, so let it catch up
+                    # before checking whether the commit landed.
+                    await self.db_conn.execute("SELECT 1")
+                committed = committing and not self.db_conn.in_transaction
+                if self.db_conn.in_transaction:
+                    await self.db_conn.rollback()
+                if not committed:
+                    # Also runs on cancellation, so close() can still write the rows back out.
+                    self._pending_sessions[:0] = batch
+                    self._pending_room_deletes[:0] = room_deletes
+                if not isinstance(e, Exception):
+                    raise
+                print(f"Error flushing {len(batch)} sessions: {e}")
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_event.wait(), timeout=SESSION_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_event.clear()
+            await self._flush_sessions()
 
     async def _perform_cleanup(self, channel_id, reason, duration_seconds=0, topic="N/A"):
         room_data = self.active_rooms.pop(channel_id, None)
@@ -77,44 +309,135 @@ class StudyBot(commands.Bot):
             return
         owner_id = room_data['owner_id']
         partner_id = room_data['partner_id']
-        start_time = room_data['start_time']
+        start_time_unix = room_data['start_time_unix']
         if duration_seconds == 0:
-            duration_seconds = int((datetime.now() - start_time).total_seconds())
-        await self._log_session(owner_id, partner_id, start_time, duration_seconds, topic)
+            # Monotonic, so a wall-clock jump (NTP, manual change) can't skew the duration.
+            duration_seconds = int(time.monotonic() - room_data['start_mono'])
+        await self._log_session(owner_id, partner_id, start_time_unix, duration_seconds, topic, channel_id=channel_id)
         self.owner_to_channel.pop(owner_id, None)
-        guild = self.get_channel(channel_id).guild
-        if not guild: return
         channel = self.get_channel(channel_id)
+        if channel is None:
+            return  # deleted by hand; bookroom strips the leftover role on the owner's next booking
+        guild = channel.guild
         role = guild.get_role(room_data['role_id'])
-        if 'timer_task' in room_data:
-            room_data['timer_task'].cancel()
-        if role:
-            try: await role.delete(reason=f"Cleanup: {reason}")
-            except: pass
-        if channel:
-            try: await channel.delete(reason=f"Cleanup: {reason}")
-            except: pass
+        # The owner's access role is kept for their next booking; only the partner loses it.
+        partner = guild.get_member(partner_id)
+        teardown = []
+        if role and partner and partner_id != owner_id:
+            teardown.append(partner.remove_roles(role, reason=f"Cleanup: {reason}"))
+        teardown.append(channel.delete(reason=f"Cleanup: {reason}"))
+        # Independent REST calls: run them together; failures are ignored as before.
+        await asyncio.gather(*teardown, return_exceptions=True)
         print(f"Cleanup complete for channel {channel_id}. Reason: {reason} (Duration: {duration_seconds}s)")
 
-    async def cleanup_room_timer(self, channel_id, duration_minutes, topic):
-        try:
-            await asyncio.sleep(duration_minutes * 60)
-            await self._perform_cleanup(channel_id, f"Timed session expired ({duration_minutes} minutes).",
-                                        duration_seconds=duration_minutes * 60, topic=topic)
-        except asyncio.CancelledError:
-            pass
-        except Exception as e:
-            print(f"Error in cleanup timer: {e}")
+    async def _get_access_role(self, guild, owner):
+        role = guild.get_role(self._user_access_role.pop(owner.id, 0))
+        if role is None:
+            role_name = f"Study-{owner.name}-Access"
+            # Fall back to a lookup by name so roles left from before a restart are reused too.
+            role = discord.utils.get(guild.roles, name=role_name)
+            if role is None:
+                await self._evict_access_roles(guild)
+                role = await guild.create_role(name=role_name, mentionable=False)
+        # Re-inserted so the dict stays ordered from least to most recently used.
+        self._user_access_role[owner.id] = role.id
+        return role
+
+    async def _evict_access_roles(self, guild):
+        """Deletes least recently used access roles until there is room for one more."""
+        in_use = {room['role_id'] for room in self.active_rooms.values()}
+        tracked = set(self._user_access_role.values())
+        access_roles = [role for role in guild.roles if role.name.startswith("Study-") and role.name.endswith("-Access")]
+        # Roles left from before a restart have no usage history, so they go first.
+        candidates = [role.id for role in access_roles if role.id not in tracked]
+        candidates += self._user_access_role.values()
+        owned, total = len(access_roles), len(guild.roles)
+        for role_id in [role_id for role_id in candidates if role_id not in in_use]:
+            if owned < ACCESS_ROLE_LIMIT and total < GUILD_ROLE_LIMIT:
+                break
+            for owner_id, owner_role_id in list(self._user_access_role.items()):
+                if owner_role_id == role_id:
+                    del self._user_access_role[owner_id]
+            role = guild.get_role(role_id)
+            if role is None:
+                continue  # already deleted by hand
+            try:
+                await role.delete(reason="Study room access role unused for the longest")
+            except discord.HTTPException as e:
+                print(f"Error deleting access role {role.name}: {e}")
+                continue
+            owned -= 1
+            total -= 1
+
+    def _schedule_expiry(self, channel_id, delay_seconds):
+        heapq.heappush(self._expiry_heap, (self.loop.time() + delay_seconds, channel_id))
+        self._expiry_event.set()
+
+    async def _expiry_dispatcher(self):
+        # One task for all rooms: sleep until the earliest deadline or until a new room is scheduled.
+        while True:
+            self._expiry_event.clear()
+            if not self._expiry_heap:
+                await self._expiry_event.wait()
+                continue
+            delay = self._expiry_heap[0][0] - self.loop.time()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._expiry_event.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            _, channel_id = heapq.heappop(self._expiry_heap)
+            room_data = self.active_rooms.get(channel_id)
+            if not room_data:
+                continue  # room was already cleaned up when it emptied
+            duration_minutes = room_data['duration_minutes']
+            try:
+                await self._perform_cleanup(channel_id, f"Timed session expired ({duration_minutes} minutes).",
+                                            duration_seconds=duration_minutes * 60, topic=room_data['topic'])
+            except Exception as e:
+                print(f"Error in cleanup timer: {e}")
+
+    def _display_name(self, guild, user_id):
+        # Display names are per-guild nicknames, so the cache is keyed by guild too.
+        key = (guild.id, user_id)
+        name = self._name_cache.get(key)
+        if name is None:
+            if (member := guild.get_member(user_id)) is None:
+                return f"User {user_id}"
+            name = self._name_cache[key] = member.display_name
+        return name
+
+    @commands.Cog.listener()
+    async def on_member_update(self, before, after):
+        self._name_cache.pop((after.guild.id, after.id), None)
+
+    @commands.Cog.listener()
+    async def on_member_remove(self, member):
+        self._name_cache.pop((member.guild.id, member.id), None)
+
+    @commands.Cog.listener()
+    async def on_user_update(self, before, after):
+        # A global name change affects every guild where the user has no nickname.
+        for key in [key for key in self._name_cache if key[1] == after.id]:
+            del self._name_cache[key]
 
     @commands.Cog.listener()
     async def on_voice_state_update(self, member, before, after):
-        if before.channel and before.channel.id in self.active_rooms and after.channel != before.channel:
-            human_members = [m for m in before.channel.members if not m.bot]
-            if not human_members:
-                room_data = self.active_rooms.get(before.channel.id, {})
-                await self._perform_cleanup(before.channel.id,
-                                            f"Study room auto-deleted because it became empty after {member.name} left.",
-                                            topic=room_data.get('topic', 'N/A'))
+        # Fires for every mute/deafen/move in the guild, so bail out as early as possible.
+        if not before.channel:
+            return
+        if after.channel == before.channel:
+            return
+        channel_id = before.channel.id
+        if channel_id not in self.active_rooms:
+            return
+        if any(not m.bot for m in before.channel.members):
+            return
+        room_data = self.active_rooms.get(channel_id, {})
+        await self._perform_cleanup(channel_id,
+                                    f"Study room auto-deleted because it became empty after {member.name} left.",
+                                    topic=room_data.get('topic', 'N/A'))
 
     # --- Slash Commands ---
     @app_commands.command(name="bookroom", description="Book a private study room with a partner for a specified duration.")
@@ -124,34 +447,51 @@ class StudyBot(commands.Bot):
         if interaction.user.id in self.owner_to_channel:
             await interaction.followup.send(f"You already have an active study room.")
             return
-        new_role = None
+        access_role = None
         new_channel = None
-        start_time = datetime.now()
+        start_time_unix = int(time.time())
+        start_mono = time.monotonic()
         try:
-            role_name = f"Study-{interaction.user.name}-Access"
-            new_role = await interaction.guild.create_role(name=role_name, mentionable=False)
-            await interaction.user.add_roles(new_role)
-            await partner.add_roles(new_role)
+            access_role = await self._get_access_role(interaction.guild, interaction.user)
+            # A reused role must only reach the owner and this booking's partner.
+            for member in access_role.members:
+                if member.id not in (interaction.user.id, partner.id):
+                    await member.remove_roles(access_role)
             overwrites = {
                 interaction.guild.default_role: discord.PermissionOverwrite(connect=False, view_channel=False),
-                new_role: discord.PermissionOverwrite(connect=True, view_channel=True),
+                access_role: discord.PermissionOverwrite(connect=True, view_channel=True),
                 interaction.guild.me: discord.PermissionOverwrite(connect=True, view_channel=True)
             }
             channel_name = f"🗣️study-{topic.lower().replace(' ','-')[:15]}"
-            new_channel = await interaction.guild.create_voice_channel(name=channel_name, overwrites=overwrites)
-            cleanup_task = self.loop.create_task(self.cleanup_room_timer(new_channel.id, duration_minutes, topic))
-            self.active_rooms[new_channel.id] = {'owner_id': interaction.user.id,
-                                                 'partner_id': partner.id,
-                                                 'role_id': new_role.id,
-                                                 'timer_task': cleanup_task,
-                                                 'start_time': start_time,
-                                                 'topic': topic}
+            # The role grants and the channel only depend on the role, so send them concurrently.
+            role_grants = [partner.add_roles(access_role)]
+            if access_role not in interaction.user.roles:
+                role_grants.append(interaction.user.add_roles(access_role))
+            *grant_results, channel_result = await asyncio.gather(
+                *role_grants,
+                interaction.guild.create_voice_channel(name=channel_name, overwrites=overwrites),
+                return_exceptions=True)
+            if not isinstance(channel_result, BaseException):
+                new_channel = channel_result  # so the except block can delete it if a grant failed
+            for result in (*grant_results, channel_result):
+                if isinstance(result, BaseException):
+                    raise result
+            room_data = {'owner_id': interaction.user.id,
+                         'partner_id': partner.id,
+                         'role_id': access_role.id,
+                         'duration_minutes': duration_minutes,
+                         'start_time_unix': start_time_unix,
+                         'start_mono': start_mono,
+                         'topic': topic}
+            # Saved before confirming, so a failed insert is never reported as a booked room.
+            await self._save_room(new_channel.id, room_data)
+            self.active_rooms[new_channel.id] = room_data
             self.owner_to_channel[interaction.user.id] = new_channel.id
-            end_time = start_time + timedelta(minutes=duration_minutes)
+            self._schedule_expiry(new_channel.id, duration_minutes * 60)
             await interaction.followup.send(f"Room booked: <#{new_channel.id}> for {duration_minutes} minutes with {partner.mention}.")
         except Exception as e:
-            if new_role:
-                try: await new_role.delete()
+            if access_role and partner.id != interaction.user.id:
+                try: await partner.remove_roles(access_role)
                 except: pass
             if new_channel:
                 try: await new_channel.delete()
@@ -162,8 +502,17 @@ class StudyBot(commands.Bot):
     async def studystats(self, interaction: discord.Interaction):
         await interaction.response.defer(thinking=True)
         user_id = interaction.user.id
-        self.db_cursor.execute('SELECT SUM(duration_seconds) FROM sessions WHERE user_id=? OR partner_id=?', (user_id,user_id))
-        total_seconds = self.db_cursor.fetchone()[0]
+        cached = self._stats_cache.get(user_id)
+        if cached and cached[1] > time.monotonic():
+            total_seconds = cached[0]
+        else:
+            generation = self._sessions_generation
+            await self._flush_sessions()
+            async with self.db_conn.execute(SQL_SUM_USER, (user_id, user_id, user_id)) as cur:
+                total_seconds = (await cur.fetchone())[0]
+            # A session logged during the query already invalidated this entry; don't cache a stale total.
+            if generation == self._sessions_generation:
+                self._stats_cache[user_id] = (total_seconds, time.monotonic() + STATS_CACHE_TTL)
         if not total_seconds:
             await interaction.followup.send("No study sessions logged yet.")
             return
@@ -174,28 +523,99 @@ class StudyBot(commands.Bot):
     @app_commands.command(name="weeklyreport", description="Generates a graph of study hours for the past week.")
     async def weeklyreport(self, interaction: discord.Interaction):
         await interaction.response.defer(thinking=True)
-        one_week_ago = datetime.now() - timedelta(days=7)
-        self.db_cursor.execute('SELECT user_id, start_time, duration_seconds FROM sessions WHERE start_time >= ?', (one_week_ago.isoformat(),))
-        rows = self.db_cursor.fetchall()
+        cached = self._report_cache.get(interaction.guild.id)
+        if cached and time.monotonic() - cached[0] < REPORT_CACHE_TTL:
+            await interaction.followup.send(file=discord.File(io.BytesIO(cached[1]), filename="weekly_report.png"))
+            return
+        generation = self._sessions_generation
+        one_week_ago = int(time.time()) - 7 * 24 * 3600
+        await self._flush_sessions()
+        async with self.db_conn.execute(SQL_WEEKLY, (one_week_ago,)) as cur:
+            rows = await cur.fetchall()
         if not rows:
             await interaction.followup.send("No sessions logged in the last 7 days.")
             return
-        data = []
-        for user_id, start_time_str, duration_seconds in rows:
-            start_time = datetime.fromisoformat(start_time_str)
-            data.append({'user_id': user_id, 'day': start_time.strftime('%A'), 'duration_hours': duration_seconds/3600})
-        df = pd.DataFrame(data)
-        weekly_summary = df.groupby(['day','user_id'])['duration_hours'].sum().reset_index()
-        user_names = {uid:(interaction.guild.get_member(uid).display_name if interaction.guild.get_member(uid) else f"User {uid}") for uid in weekly_summary['user_id'].unique()}
-        weekly_summary['name'] = weekly_summary['user_id'].map(user_names)
         days_order = ['Monday','Tuesday','Wednesday','Thursday','Friday','Saturday','Sunday']
-        fig, ax = plt.subplots(figsize=(10,6))
-        plot_data = weekly_summary.pivot(index='day',columns='name',values='duration_hours').fillna(0).reindex(days_order, fill_value=0)
-        plot_data.plot(kind='bar', ax=ax, rot=45, colormap='viridis')
-        ax.set_title('Study Time Last 7 Days'); ax.set_xlabel('Day'); ax.set_ylabel('Hours')
-        plt.tight_layout()
-        buffer = io.BytesIO(); plt.savefig(buffer, format='png'); buffer.seek(0); plt.close(fig)
-        await interaction.followup.send(file=discord.File(buffer, filename="weekly_report.png"))
+        hours_by_user: dict[int, list[float]] = defaultdict(lambda: [0.0] * 7)
+        for user_id, dow, hours in rows:
+            hours_by_user[user_id][(dow - 1) % 7] += hours  # strftime('%w') counts from Sunday
+        user_names = {uid: self._display_name(interaction.guild, uid) for uid in hours_by_user}
+        series = {}
+        for uid in sorted(hours_by_user, key=user_names.get):
+            name = user_names[uid] if user_names[uid] not in series else f"{user_names[uid]} ({uid})"
+            series[name] = hours_by_user[uid]
+        png_bytes = await asyncio.to_thread(self._render_report, days_order, series)
+        if generation == self._sessions_generation:
+            self._report_cache[interaction.guild.id] = (time.monotonic(), png_bytes)
+        await interaction.followup.send(file=discord.File(io.BytesIO(png_bytes), filename="weekly_report.png"))
+
+    def _render_report(self, days, series):
+        """Draws a grouped bar chart of hours per day for each name in `series` and returns PNG bytes."""
+        # Imported here so Pillow is only loaded once someone actually asks for a report.
+        from PIL import Image, ImageDraw, ImageFont
+        width, height = 1000, 600
+        left, right, top, bottom = 70, 190, 50, 70  # plot margins; legend sits in the right one
+        plot_w, plot_h = width - left - right, height - top - bottom
+        img = Image.new('RGB', (width, height), 'white')
+        draw = ImageDraw.Draw(img)
+        font = ImageFont.load_default(size=14)
+        title_font = ImageFont.load_default(size=18)
+
+        def text_centered(x, y, text, fnt=font):
+            draw.text((x - draw.textlength(text, font=fnt) / 2, y), text, fill='black', font=fnt)
+
+        # Y axis: pick a 1/2/2.5/5 x 10^n step giving about five gridlines.
+        peak = max((max(values) for values in series.values()), default=0) or 1
+        magnitude = 10 ** math.floor(math.log10(peak / 5))
+        step = next(m * magnitude for m in (1, 2, 2.5, 5, 10) if m * magnitude >= peak / 5)
+        y_max = math.ceil(peak / step) * step
+        for i in range(round(y_max / step) + 1):
+            value = i * step
+            y = top + plot_h - value / y_max * plot_h
+            draw.line([(left, y), (left + plot_w, y)], fill=(225,225,225))
+            label = f"{value:g}"
+            draw.text((left - 8 - draw.textlength(label, font=font), y - 8), label, fill='black', font=font)
+
+        # Bars, grouped by day with one colour per series.
+        n = len(series)
+        colors = []
+        for i in range(n):
+            pos = (i / (n - 1) if n > 1 else 0) * (len(REPORT_PALETTE) - 1)
+            lo = min(int(pos), len(REPORT_PALETTE) - 2)
+            frac = pos - lo
+            colors.append(tuple(round(a + (b - a) * frac) for a, b in zip(REPORT_PALETTE[lo], REPORT_PALETTE[lo + 1])))
+        group_w = plot_w / len(days)
+        bar_w = group_w * 0.8 / max(n, 1)
+        for d, day in enumerate(days):
+            group_x = left + d * group_w + group_w * 0.1
+            for i, values in enumerate(series.values()):
+                if values[d] > 0:
+                    x0 = group_x + i * bar_w
+                    # Keep at least a 1px bar when there are more series than the group has pixels.
+                    draw.rectangle([x0, top + plot_h - values[d] / y_max * plot_h, x0 + max(bar_w - 1, 0), top + plot_h], fill=colors[i])
+            text_centered(left + (d + 0.5) * group_w, top + plot_h + 8, day)
+
+        draw.line([(left, top), (left, top + plot_h), (left + plot_w, top + plot_h)], fill='black')
+        text_centered(width / 2, 15, 'Study Time Last 7 Days', title_font)
+        text_centered(left + plot_w / 2, height - 30, 'Day')
+        hours_label = Image.new('RGB', (60, 20), 'white')
+        ImageDraw.Draw(hours_label).text((0, 0), 'Hours', fill='black', font=font)
+        img.paste(hours_label.rotate(90, expand=True), (10, top + plot_h // 2 - 30))
+
+        legend_rows = (height - top) // 22
+        names = list(series)
+        if len(names) > legend_rows:
+            names = names[:legend_rows - 1]
+        for i, name in enumerate(names):
+            y = top + i * 22
+            draw.rectangle([left + plot_w + 20, y + 3, left + plot_w + 32, y + 15], fill=colors[i])
+            draw.text((left + plot_w + 40, y), str(name)[:18], fill='black', font=font)
+        if len(names) < n:
+            draw.text((left + plot_w + 40, top + len(names) * 22), f"+{n - len(names)} more", fill='black', font=font)
+
+        buffer = io.BytesIO()
+        img.save(buffer, 'PNG', optimize=False)
+        return buffer.getvalue()
 
 bot = StudyBot()
 bot.run(BOT_TOKEN)